@@ -1,6 +1,7 @@
 """Generator function to supply train/test with text data"""
 
 import numpy as np
+import tensorflow as tf
 from data import preproc as pp, reader
 
 
@@ -39,8 +40,31 @@ class DataGenerator():
             ratio, iterations = pp.add_noise.__defaults__
             pp.add_noise.__defaults__ = (ratio, iterations + 2)
 
+        # encoded sentences of each partition (see `encode_partition`)
+        self.encoded = dict()
+
+    def encode_partition(self, partition):
+        """
+        Encode the sentences of the partition only once, at its first batch
+        (the noised train inputs change, so they are encoded by batch)
+        """
+
+        if partition not in self.encoded:
+            self.encoded[partition] = dict()
+
+            dt, gt = self.dataset[partition]['dt'], self.dataset[partition]['gt']
+
+            if not (partition == 'train' and self.noise_process):
+                self.encoded[partition]['inputs'] = self.prepare_sequence(dt, sos=True, eos=True)
+
+            if partition != 'test':
+                self.encoded[partition]['decoder_inputs'] = self.prepare_sequence(gt, sos=True)
+                self.encoded[partition]['targets'] = self.prepare_sequence(gt, eos=True)
+
+        return self.encoded[partition]
+
     def prepare_sequence(self, sentences, sos=False, eos=False, add_noise=False):
-        """Prepare inputs to feed the model"""
+        """Prepare inputs to feed the model (encoded and padded)"""
 
         n_sen = list(sentences).copy()
 
@@ -54,15 +78,21 @@ class DataGenerator():
             n_sen[i] = self.tokenizer.encode(sos + n_sen[i] + eos)
             n_sen[i] = np.pad(n_sen[i], (0, self.tokenizer.maxlen - len(n_sen[i])))
 
-            if self.one_hot_process:
-                n_sen[i] = self.tokenizer.encode_one_hot(n_sen[i])
+        return np.asarray(n_sen, dtype=np.int16).reshape((-1, self.tokenizer.maxlen))
+
+    def feed(self, sequences):
+        """Convert the encoded sequences to the model input format (one-hot or not)"""
+
+        if self.one_hot_process:
+            sequences = self.tokenizer.encode_one_hot(sequences)
 
-        return np.asarray(n_sen, dtype=np.int16)
+        return np.asarray(sequences, dtype=np.int16)
 
     def next_train_batch(self):
         """Get the next batch from train partition (yield)"""
 
         self.index['train'] = 0
+        encoded = self.encode_partition('train')
 
         while True:
             if self.index['train'] >= self.size['train']:
@@ -72,19 +102,22 @@ class DataGenerator():
             until = index + self.batch_size
             self.index['train'] = until
 
-            targets = self.dataset['train']['gt'][index:until]
-            inputs = targets if self.noise_process else self.dataset['train']['dt'][index:until]
+            if self.noise_process:
+                inputs = self.dataset['train']['gt'][index:until]
+                inputs = self.prepare_sequence(inputs, sos=True, eos=True, add_noise=True)
+            else:
+                inputs = encoded['inputs'][index:until]
 
-            inputs = self.prepare_sequence(inputs, sos=True, eos=True, add_noise=self.noise_process)
-            decoder_inputs = self.prepare_sequence(targets, sos=True)
-            targets = self.prepare_sequence(targets, eos=True)
+            decoder_inputs = encoded['decoder_inputs'][index:until]
+            targets = encoded['targets'][index:until]
 
-            yield ([inputs, decoder_inputs], targets)
+            yield ([self.feed(inputs), self.feed(decoder_inputs)], self.feed(targets))
 
     def next_valid_batch(self):
         """Get the next batch from valid partition (yield)"""
 
         self.index['valid'] = 0
+        encoded = self.encode_partition('valid')
 
         while True:
             if self.index['valid'] >= self.size['valid']:
@@ -94,19 +127,17 @@ class DataGenerator():
             until = index + self.batch_size
             self.index['valid'] = until
 
-            inputs = self.dataset['valid']['dt'][index:until]
-            targets = self.dataset['valid']['gt'][index:until]
+            inputs = encoded['inputs'][index:until]
+            decoder_inputs = encoded['decoder_inputs'][index:until]
+            targets = encoded['targets'][index:until]
 
-            inputs = self.prepare_sequence(inputs, sos=True, eos=True)
-            decoder_inputs = self.prepare_sequence(targets, sos=True)
-            targets = self.prepare_sequence(targets, eos=True)
-
-            yield ([inputs, decoder_inputs], targets)
+            yield ([self.feed(inputs), self.feed(decoder_inputs)], self.feed(targets))
 
     def next_test_batch(self):
         """Get the next batch from test partition (yield)"""
 
         self.index['test'] = 0
+        encoded = self.encode_partition('test')
 
         while True:
             if self.index['test'] >= self.size['test']:
@@ -117,11 +148,36 @@ class DataGenerator():
             until = index + self.batch_size
             self.index['test'] = until
 
-            inputs = self.dataset['test']['dt'][index:until]
+            inputs = encoded['inputs'][index:until]
+
+            yield [self.feed(inputs)]
+
+    def get_dataset(self, partition):
+        """Get the batches of the partition as a tf.data pipeline (prefetched while the model computes)"""
 
-            inputs = self.prepare_sequence(inputs, sos=True, eos=True)
+        if self.one_hot_process:
+            shape = tf.TensorShape([None, self.tokenizer.maxlen, self.tokenizer.vocab_size])
+        else:
+            shape = tf.TensorShape([None, self.tokenizer.maxlen])
 
-            yield [inputs]
+        if partition == "test":
+            def generator():
+                for inputs in self.next_test_batch():
+                    yield tuple(inputs)
+
+            output_types, output_shapes = (tf.int16,), (shape,)
+        else:
+            batches = self.next_train_batch if partition == "train" else self.next_valid_batch
+
+            def generator():
+                for inputs, targets in batches():
+                    yield tuple(inputs), targets
+
+            output_types, output_shapes = ((tf.int16, tf.int16), tf.int16), ((shape, shape), shape)
+
+        dataset = tf.data.Dataset.from_generator(generator, output_types=output_types, output_shapes=output_shapes)
+
+        return dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
 
 class Tokenizer():
@@ -139,17 +195,16 @@ class Tokenizer():
         self.vocab_size = len(self.chars)
         self.maxlen = max_text_length
 
-    def encode(self, text):
-        """Encode text to vector"""
+        # index of each char (the first one, as `str.find`)
+        self.char_index = dict()
 
-        encoded = []
+        for index, char in enumerate(self.chars):
+            self.char_index.setdefault(char, index)
 
-        for item in text:
-            index = self.chars.find(item)
-            index = self.UNK if index == -1 else index
-            encoded.append(index)
+    def encode(self, text):
+        """Encode text to vector"""
 
-        return np.asarray(encoded)
+        return np.asarray([self.char_index.get(item, self.UNK) for item in text], dtype=int)
 
     def decode(self, text):
         """Decode vector to text"""
@@ -159,15 +214,7 @@ class Tokenizer():
     def encode_one_hot(self, vector):
         """Encode vector to one-hot"""
 
-        encoded = np.zeros((len(vector), self.vocab_size), dtype=bool)
-
-        for i in range(len(vector)):
-            try:
-                encoded[i][int(vector[i])] = 1
-            except KeyError:
-                encoded[i][int(self.UNK)] = 1
-
-        return encoded
+        return np.eye(self.vocab_size, dtype=bool)[np.asarray(vector, dtype=int)]
 
     def decode_one_hot(self, one_hot):
         """Decode one-hot to vector"""
@@ -38,14 +38,20 @@ class Dataset():
         dataset = [pp.text_standardize(x) for x in dataset]
         dataset = [x for x in dataset if self.check_text(x)]
 
-        dataset = list(set(dataset))
-        np.random.shuffle(dataset)
+        # order-preserving deduplication (deterministic, unlike the set iteration order)
+        dataset = np.asarray(list(dict.fromkeys(dataset)), dtype=object)
+
+        # seeded shuffle (as the data generator), so the partitions are the same across runs
+        # a local generator, so the global random state (e.g. of the noise process) is not reseeded
+        np.random.RandomState(42).shuffle(dataset)
 
         index = int(len(dataset) * 0.1)
-        self.dataset['train'] = dataset[index:]
-        self.dataset['valid'] = dataset[:index]
-        self.dataset['test'] = dataset[:32]  # just a sample
-        del dataset
+        valid, train = np.split(dataset, [index])
+
+        self.dataset['train'] = train.tolist()
+        self.dataset['valid'] = valid.tolist()
+        self.dataset['test'] = valid[:32].tolist()  # just a sample
+        del dataset, train, valid
 
         for pt in self.partitions:
             self.size[pt] = len(self.dataset[pt])
@@ -114,11 +120,11 @@ class Dataset():
         for m2_file in m2_list:
             if "2010" in m2_file and ".en" in m2_file:
                 with open(os.path.join(basedir, m2_file)) as f:
-                    lines_en = list(set([line for line in f]))[::-1]
+                    lines_en = list(dict.fromkeys(f))[::-1]
 
             elif "2009" in m2_file and ".fr" in m2_file:
                 with open(os.path.join(basedir, m2_file)) as f:
-                    lines_fr = list(set([line for line in f]))[::-1]
+                    lines_fr = list(dict.fromkeys(f))[::-1]
 
         # English and french will be 1% samples.
         lines_en = lines_en[:int(len(lines_en) * 0.01)]
@@ -214,10 +214,10 @@ if __name__ == "__main__":
 
                 start_time = datetime.datetime.now()
 
-                h = model.fit(x=dtgen.next_train_batch(),
+                h = model.fit(x=dtgen.get_dataset('train'),
                               epochs=args.epochs,
                               steps_per_epoch=dtgen.steps['train'],
-                              validation_data=dtgen.next_valid_batch(),
+                              validation_data=dtgen.get_dataset('valid'),
                               validation_steps=dtgen.steps['valid'],
                               callbacks=callbacks,
                               shuffle=True,
@@ -257,7 +257,7 @@ if __name__ == "__main__":
             elif args.test:
                 start_time = datetime.datetime.now()
 
-                predicts = model.predict(x=dtgen.next_test_batch(), steps=dtgen.steps['test'], verbose=1)
+                predicts = model.predict(x=dtgen.get_dataset('test'), steps=dtgen.steps['test'], verbose=1)
                 predicts = [pp.text_standardize(x) for x in predicts]
 
                 total_time = datetime.datetime.now() - start_time
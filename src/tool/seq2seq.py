@@ -12,19 +12,21 @@ References:
 """
 
 import os
-import numpy as np
 import tensorflow as tf
 
 from contextlib import redirect_stdout
 from tensorflow.keras import Model
 from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.utils import Progbar, GeneratorEnqueuer
+from tensorflow.keras.utils import Progbar
 
 from tensorflow.keras.callbacks import CSVLogger, TensorBoard, ModelCheckpoint
 from tensorflow.keras.callbacks import EarlyStopping, ReduceLROnPlateau
 from tensorflow.keras.layers import Concatenate, LayerNormalization, Attention, AdditiveAttention
 from tensorflow.keras.layers import Input, Bidirectional, GRU, TimeDistributed, Dense
 
+# built once, instead of at each loss computation
+LOSS_OBJECT = tf.keras.losses.CategoricalCrossentropy(label_smoothing=0.1, reduction="none")
+
 
 class Seq2SeqAttention():
     """
@@ -45,6 +47,9 @@ class Seq2SeqAttention():
         self.encoder = None
         self.decoder = None
 
+        self.encoder_fn = None
+        self.decoder_fn = None
+
     def summary(self, output=None, target=None):
         """Show/Save model structure (summary)"""
 
@@ -206,6 +211,17 @@ class Seq2SeqAttention():
         self.decoder = Model(inputs=[encoder_inf_states, decoder_init_states, decoder_inf_inputs],
                              outputs=[decoder_inf_pred, decoder_inf_states])
 
+        """ Inference functions (traced once, without the `predict` overhead at each decoding step) """
+        self.encoder_fn = tf.function(
+            lambda x: self.encoder(x, training=False),
+            input_signature=[tf.TensorSpec((None, None, self.tokenizer.vocab_size), tf.float32)])
+
+        self.decoder_fn = tf.function(
+            lambda states, init, x: self.decoder([states, init, x], training=False),
+            input_signature=[tf.TensorSpec((None, self.tokenizer.maxlen, self.units * 2), tf.float32),
+                             tf.TensorSpec((None, self.units * 2), tf.float32),
+                             tf.TensorSpec((None, 1, self.tokenizer.vocab_size), tf.float32)])
+
     def fit(self,
             x=None,
             y=None,
@@ -258,7 +274,7 @@ class Seq2SeqAttention():
                 workers=1,
                 use_multiprocessing=False):
         """
-        Model predicting on data yielded (generator).
+        Model predicting on data yielded (tf.data.Dataset).
         A predict() abstration function of TensorFlow 2 using the encoder and decoder models
 
         :param: See tensorflow.keras.Model.predict()
@@ -275,68 +291,48 @@ class Seq2SeqAttention():
             Github: https://github.com/vuptran/deep-spell-checkr
         """
 
-        try:
-            enqueuer = GeneratorEnqueuer(x, use_multiprocessing=use_multiprocessing)
-            enqueuer.start(workers=workers, max_queue_size=max_queue_size)
-            output_generator = enqueuer.get()
-
-            steps_done = 0
-            if verbose == 1:
-                print("Model Predict")
-                progbar = Progbar(target=steps)
-
-            predicts = []
+        steps_done = 0
+        if verbose == 1:
+            print("Model Predict")
+            progbar = Progbar(target=steps)
 
-            while steps_done < steps:
-                x = next(output_generator)[0]
-                batch_size = len(x)
+        predicts = []
 
-                # Encode the input as state vectors
-                encoder_out, state_h, state_c = self.encoder.predict(x)
-                dec_state = tf.concat([state_h, state_c], axis=-1)
+        # the dataset yields the (prefetched) batches as tuples of inputs
+        for (x,) in x.take(steps):
+            batch_size = len(x)
 
-                # Create batch of empty target sequences of length 1 character and populate
-                # the first element of target sequence with the # start-of-sequence character
-                target = np.zeros((batch_size, 1, self.tokenizer.vocab_size))
-                target[:, 0, self.tokenizer.SOS] = 1.0
+            # Encode the input as state vectors
+            encoder_out, state_h, state_c = self.encoder_fn(tf.cast(x, tf.float32))
+            dec_state = tf.concat([state_h, state_c], axis=-1)
 
-                # Sampling loop for a batch of sequences
-                decoded_tokens = [''] * batch_size
+            # Create batch of target sequences of length 1 character with
+            # the start-of-sequence character (one-hot)
+            target = tf.one_hot(tf.fill([batch_size, 1], self.tokenizer.SOS), self.tokenizer.vocab_size)
 
-                for _ in range(self.tokenizer.maxlen):
-                    # `char_probs` has shape (batch_size, 1, nb_target_chars)
-                    char_probs, dec_state = self.decoder.predict([encoder_out, dec_state, target])
+            # Sampling loop for a batch of sequences (the indexes of each step, all the batch at once)
+            decoded_indexes = []
 
-                    # Reset the target sequences.
-                    target = np.zeros((batch_size, 1, self.tokenizer.vocab_size))
+            for _ in range(self.tokenizer.maxlen):
+                # `char_probs` has shape (batch_size, 1, nb_target_chars)
+                char_probs, dec_state = self.decoder_fn(encoder_out, dec_state, target)
 
-                    # Sample next character using argmax or multinomial mode
-                    sampled_chars = []
+                # Sample next character using argmax and update target sequence with it
+                next_index = tf.argmax(char_probs, axis=-1, output_type=tf.int32)  # (batch_size, 1)
+                target = tf.one_hot(next_index, self.tokenizer.vocab_size)
 
-                    for i in range(batch_size):
-                        next_index = char_probs[i].argmax(axis=-1)
-                        next_char = self.tokenizer.decode([next_index])
+                decoded_indexes.append(next_index)
 
-                        decoded_tokens[i] += next_char
-                        sampled_chars.append(next_char)
+                if tf.reduce_all(tf.equal(next_index, self.tokenizer.EOS)):
+                    break
 
-                        # Update target sequence with index of next character
-                        target[i, 0, next_index] = 1.0
+            # Sampling finished
+            decoded_indexes = tf.concat(decoded_indexes, axis=-1).numpy()
+            predicts.extend([self.tokenizer.remove_tokens(self.tokenizer.decode(x)) for x in decoded_indexes])
 
-                    stop_char = set(sampled_chars)
-
-                    if len(stop_char) == 1 and stop_char.pop() == self.tokenizer.EOS_TK:
-                        break
-
-                # Sampling finished
-                predicts.extend([self.tokenizer.remove_tokens(x) for x in decoded_tokens])
-
-                steps_done += 1
-                if verbose == 1:
-                    progbar.update(steps_done)
-
-        finally:
-            enqueuer.stop()
+            steps_done += 1
+            if verbose == 1:
+                progbar.update(steps_done)
 
         return predicts
 
@@ -344,7 +340,7 @@ class Seq2SeqAttention():
     def loss_func(y_true, y_pred):
         """Loss function with CategoryCrossentropy and label smoothing"""
 
-        return tf.keras.losses.CategoricalCrossentropy(label_smoothing=0.1, reduction="none")(y_true, y_pred)
+        return LOSS_OBJECT(y_true, y_pred)
 
 
 """
@@ -372,8 +368,13 @@ class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
         self.initial_step = initial_step
         self.warmup_steps = warmup_steps
 
+        # the constant factors of the schedule are computed only once
+        self.rsqrt_d_model = tf.math.rsqrt(self.d_model)
+        self.warmup_factor = self.warmup_steps**-1.5
+
+    @tf.function(input_signature=[tf.TensorSpec([], tf.float32)])
     def __call__(self, step):
         arg1 = tf.math.rsqrt(step + self.initial_step)
-        arg2 = step * (self.warmup_steps**-1.5)
+        arg2 = step * self.warmup_factor
 
-        return tf.math.rsqrt(self.d_model) * tf.math.minimum(arg1, arg2)
+        return self.rsqrt_d_model * tf.math.minimum(arg1, arg2)
@@ -9,36 +9,198 @@ Statistical techniques for spelling correction:
 """
 
 import os
-import re
 import string
+import functools
+import itertools
+import collections
+import multiprocessing
 
 from ngram import NGram
 from spellchecker import SpellChecker
 from symspellpy.symspellpy import SymSpell
 
+PUNCTUATION = frozenset(string.punctuation)
+PUNCTUATION_REMOVE_TABLE = str.maketrans("", "", string.punctuation)
+
+# minimum number of distinct tokens to split the autocorrect work across processes
+PARALLEL_MIN_TOKENS = 2000
+
+# symspell prefix length of the low memory mode (must be greater than the edit distance)
+SYMSPELL_LOW_MEMORY_PREFIX = 5
+
+# autocorrect tools already built, by (mode, corpus path, N, low memory, corpus mtime)
+TOOL_CACHE = dict()
+TOOL_ATTRIBUTES = ("corpus", "ngram", "norvig", "trie", "symspell", "length_range", "lookup")
+
 
 class LanguageModel():
 
-    def __init__(self, mode, output, N=2):
-        self.autocorrect = getattr(self, f"_{mode}")
+    def __init__(self, mode, output, N=2, workers=None, low_memory=False):
+        modes = {
+            "similarity": self._similarity,
+            "norvig": self._norvig,
+            "symspell": self._symspell,
+            "kaldi": self._kaldi,
+        }
+
+        assert mode in modes, f"mode must be one of: {', '.join(modes)}"
+
+        # bound once, so each call goes straight to the method of the mode
+        self.autocorrect = modes[mode]
+        self.mode = mode
         self.output_path = output
         self.N = N
+        self.workers = workers or os.cpu_count() or 1
+        self.low_memory = low_memory
 
     def create_corpus(self, sentences):
         """Create corpus file"""
 
-        matches = " ¶ ".join(sentences).translate(str.maketrans("", "", string.punctuation))
-        matches = re.compile(r'[^\S\n]+', re.UNICODE).sub(" ", matches.strip())
-        matches = "\n".join(matches.strip().split(" ¶ ")).lower()
+        # one line per sentence, without punctuation marks and with normalized whitespaces
+        matches = "\n".join(" ".join(x.translate(PUNCTUATION_REMOVE_TABLE).split()) for x in sentences)
 
-        return matches
+        return matches.lower()
 
     def read_corpus(self, corpus_path):
-        """Read corpus file to the autocorrect tool"""
+        """Read corpus file and build the autocorrect tool"""
 
         self.corpus_path = corpus_path
-        self.dictionary_path = os.path.join(os.path.dirname(corpus_path), "dictionary.txt")
-        self.corpus = " ".join(open(corpus_path).read().splitlines()).lower()
+
+        # the tools are read-only once built, so the models of the same corpus share them
+        key = (self.mode, os.path.abspath(corpus_path), self.N, self.low_memory, os.path.getmtime(corpus_path))
+
+        if key in TOOL_CACHE:
+            self.__dict__.update(TOOL_CACHE[key])
+            return
+
+        with open(corpus_path) as f:
+            self.corpus = f.read().replace("\n", " ").lower()
+
+        if self.mode == "similarity":
+            # corpus is already lowercase, so index each distinct word once (in corpus order)
+            self.ngram = NGram(dict.fromkeys(self.corpus.split()), N=self.N)
+            self.lookup = self.ngram_find
+
+        elif self.mode == "norvig":
+            self.norvig = SpellChecker(distance=self.N)
+
+            # same of `load_words`, but counting the (already lowercase) corpus words at once
+            self.norvig.word_frequency.dictionary.update(collections.Counter(self.corpus.split()))
+            self.norvig.word_frequency._update_dictionary()
+
+            self.length_range = self._length_range(self.norvig.word_frequency.dictionary)
+
+            # same candidate words of the `known` function of the pyspellchecker
+            check = self.norvig._check_if_should_check
+            self.trie = WordTrie(x for x in self.norvig.word_frequency.dictionary if check(x))
+
+            def lookup(x):
+                # the word itself is returned when there is no candidate (as `SpellChecker.correction`)
+                if len(x) not in self.length_range or x in self.norvig or not check(x):
+                    return x
+
+                # edit distance 1 permutations are cheap, but the edit distance 2 ones explode
+                candidates = self.norvig.known(self.norvig.edit_distance_1(x))
+
+                if not candidates and self.norvig.distance == 2:
+                    candidates = self.trie.search(x, max_distance=2)
+
+                if not candidates:
+                    return x
+
+                return max(sorted(candidates), key=self.norvig.word_frequency.dictionary.get)
+
+            self.lookup = lookup
+
+        elif self.mode == "symspell":
+            # shorter prefixes mean fewer deletes to precalculate and store (symspellpy default is 7)
+            prefix_length = max(SYMSPELL_LOW_MEMORY_PREFIX, self.N + 1) if self.low_memory else 7
+            self.symspell = SymSpell(max_dictionary_edit_distance=self.N, prefix_length=prefix_length)
+
+            # the delete structure depends on the corpus, edit distance and prefix length used to build it
+            pickle_path = f"{self.corpus_path}.symspell_{self.N}_{prefix_length}.pickle"
+
+            # reuse the precalculated deletes of previous runs, if they are newer than the corpus
+            if not (os.path.isfile(pickle_path) and
+                    os.path.getmtime(pickle_path) >= os.path.getmtime(self.corpus_path) and
+                    self.symspell.load_pickle(pickle_path, compressed=False)):
+                self.symspell.create_dictionary(self.corpus_path)
+                self.symspell.save_pickle(pickle_path, compressed=False)
+
+            self.length_range = self._length_range(self.symspell.words)
+
+            def lookup(x):
+                if len(x) not in self.length_range:
+                    return None
+
+                sugg = self.symspell.lookup(x, verbosity=0, max_edit_distance=self.N, transfer_casing=True)
+                return sugg[0].term if sugg else None
+
+            self.lookup = lookup
+
+        # memoize the corrections, since the tokens repeat a lot across the sentences (kaldi has no lookup)
+        if hasattr(self, "lookup"):
+            self.lookup = functools.lru_cache(maxsize=None)(self.lookup)
+
+        TOOL_CACHE[key] = {x: getattr(self, x) for x in TOOL_ATTRIBUTES if hasattr(self, x)}
+
+    def _length_range(self, words):
+        """Range of token lengths that can be within N edits of some word of the vocabulary"""
+
+        lengths = set(map(len, words)) or {0}
+
+        return range(min(lengths) - self.N, max(lengths) + self.N + 1)
+
+    def ngram_find(self, query):
+        """
+        Best match of the query in the n-gram index (same result of ``NGram.find``).
+        It scores only the words of the posting lists of the query n-grams and keeps the best one,
+        instead of building and sorting the list of all matches.
+        """
+
+        shared = collections.Counter()
+        postings = self.ngram._grams
+
+        for gram, query_count in collections.Counter(self.ngram.split(query)).items():
+            for match, count in postings.get(gram, {}).items():
+                shared[match] += min(query_count, count)
+
+        if not shared:
+            return None
+
+        query_length = len(self.ngram.pad(query)) - (2 * self.N) + 2
+
+        def similarity(match):
+            allgrams = query_length + self.ngram.length[match] - shared[match]
+            return NGram.ngram_similarity(shared[match], allgrams, self.ngram.warp)
+
+        return max(shared, key=similarity)
+
+    def _correct(self, sentences):
+        """Correct the sentences, looking up each distinct token of the batch only once"""
+
+        if not isinstance(sentences, list):
+            sentences = [sentences]
+
+        # split each sentence once and work on the flat list of tokens of the whole batch
+        splitted = [sentence.split() for sentence in sentences]
+        flat = list(itertools.chain.from_iterable(splitted))
+
+        tokens = [x for x in dict.fromkeys(flat) if x not in PUNCTUATION]
+
+        if self.workers > 1 and len(tokens) >= PARALLEL_MIN_TOKENS:
+            initargs = (self.mode, self.output_path, self.N, self.low_memory, self.corpus_path)
+
+            with multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=initargs) as pool:
+                suggestions = pool.map(_lookup, tokens, chunksize=64)
+        else:
+            suggestions = [self.lookup(x.lower()) for x in tokens]
+
+        corrections = {x: sugg for x, sugg in zip(tokens, suggestions) if sugg}
+
+        flat = iter(list(map(corrections.get, flat, flat)))
+
+        return [" ".join(itertools.islice(flat, len(sentence))) for sentence in splitted]
 
     def _kaldi(self, sentences, predict=True):
         """
@@ -100,22 +262,7 @@ class LanguageModel():
             Python module: ngram (https://pypi.org/project/ngram/)
         """
 
-        ngram = NGram(self.corpus.split(), key=lambda x: x.lower(), N=self.N)
-        predicts = []
-
-        if not isinstance(sentences, list):
-            sentences = [sentences]
-
-        for i in range(len(sentences)):
-            split = []
-
-            for x in sentences[i].split():
-                sugg = ngram.find(x.lower()) if x not in string.punctuation else None
-                split.append(sugg if sugg else x)
-
-            predicts.append(" ".join(split))
-
-        return predicts
+        return self._correct(sentences)
 
     def _norvig(self, sentences):
         """
@@ -124,6 +271,9 @@ class LanguageModel():
         and transpositions) to known words in a word frequency list.
         Those words that are found more often in the frequency list are more likely the correct results.
 
+        Instead of generating all the edit distance 2 permutations, the known words within this distance
+        are searched directly in a trie of the word frequency list (see ``WordTrie``).
+
         Reference:
             Stuart J. Russell and Peter Norvig.
             Artificial intelligence - a modern approach: the intelligent agent book, 1995.
@@ -133,23 +283,7 @@ class LanguageModel():
             Python module: pyspellchecker (https://pypi.org/project/pyspellchecker/)
         """
 
-        norvig = SpellChecker(distance=self.N)
-        norvig.word_frequency.load_words(self.corpus.split())
-        predicts = []
-
-        if not isinstance(sentences, list):
-            sentences = [sentences]
-
-        for i in range(len(sentences)):
-            split = []
-
-            for x in sentences[i].split():
-                sugg = norvig.correction(x.lower()) if x not in string.punctuation else None
-                split.append(sugg if sugg else x)
-
-            predicts.append(" ".join(split))
-
-        return predicts
+        return self._correct(sentences)
 
     def _symspell(self, sentences):
         """
@@ -163,27 +297,123 @@ class LanguageModel():
             Python module: symspellpy (https://github.com/mammothb/symspellpy)
         """
 
-        symspell = SymSpell(max_dictionary_edit_distance=self.N)
-        symspell.create_dictionary(self.corpus_path)
+        return self._correct(sentences)
 
-        with open(self.dictionary_path, "w") as f:
-            for key, count in symspell.words.items():
-                f.write(f"{key} {count}\n")
 
-        symspell.load_dictionary(self.dictionary_path, term_index=0, count_index=1)
-        predicts = []
+class WordTrie():
+    """
+    Trie of words to search by Damerau-Levenshtein distance.
 
-        if not isinstance(sentences, list):
-            sentences = [sentences]
+    The distance matrix of the query is computed row by row along the trie paths (one row per level),
+    so the words with the same prefix share the rows of the prefix, and the branches that can no longer
+    be within the max distance are pruned. It works as a Levenshtein automaton walking over the trie.
+
+    References:
+        Steve Hanov.
+        Fast and Easy Levenshtein distance using a Trie, 2011.
+        URL: http://stevehanov.ca/blog/?id=114
+
+        Roy Lowrance and Robert A. Wagner.
+        An Extension of the String-to-String Correction Problem, 1975.
+        Journal of the ACM.
+    """
+
+    def __init__(self, words):
+        self.root = dict()
+
+        for word in words:
+            node = self.root
+
+            for char in word:
+                node = node.setdefault(char, dict())
+
+            node[None] = word
+
+    def search(self, query, max_distance):
+        """Return the words (and the distances) within the max distance of the query"""
+
+        # rows[0] is the "-1" row of the matrix, rows[1] is the row of the empty prefix
+        infinity = len(query) + max_distance + 2
+        rows = [[infinity] * (len(query) + 2), [infinity] + list(range(len(query) + 1))]
+        matches = dict()
+
+        for char, node in self.root.items():
+            if char is not None:
+                self._search(query, max_distance, char, node, rows, dict(), 0, matches)
+
+        return matches
+
+    def _search(self, query, max_distance, char, node, rows, last_rows, bound, matches):
+        """Compute the row of the `char` level and go down the trie while it can still match"""
+
+        i, prev, infinity = len(rows) - 1, rows[-1], rows[0][0]
+        row, last_col = [infinity] * len(prev), 0
+        row[1] = i
+
+        # only the cells of the diagonal band |i - j| <= max_distance can be within the max distance
+        for j in range(max(1, i - max_distance), min(len(query), i + max_distance) + 1):
+            query_char = query[j - 1]
+
+            # deletion, insertion and substitution (free if the chars match)
+            cost = prev[j] if char == query_char else prev[j] + 1
+
+            if row[j] + 1 < cost:
+                cost = row[j] + 1
+            if prev[j + 1] + 1 < cost:
+                cost = prev[j + 1] + 1
+
+            # transposition, with the last row (k) of the query char and the last column of the char
+            k = last_rows.get(query_char, 0)
+            transposition = rows[k][last_col] + i - k + j - last_col - 1
+
+            if transposition < cost:
+                cost = transposition
+            if char == query_char:
+                last_col = j
+
+            row[j + 1] = cost
+
+        if None in node and row[-1] <= max_distance:
+            matches[node[None]] = row[-1]
+
+        # lower bound of the next rows (transpositions can look back at the previous rows)
+        bound = min(bound + 1, min(row))
+
+        if bound <= max_distance:
+            previous_last_row = last_rows.get(char)
+            last_rows[char] = i
+            rows.append(row)
+
+            for next_char, child in node.items():
+                if next_char is not None:
+                    self._search(query, max_distance, next_char, child, rows, last_rows, bound, matches)
+
+            rows.pop()
+
+            if previous_last_row is None:
+                del last_rows[char]
+            else:
+                last_rows[char] = previous_last_row
+
+
+"""
+Pool worker functions (module level, so they can be pickled).
+Each worker process builds its own autocorrect tool once and keeps it for all its tokens.
+"""
+
+_worker_model = None
+
+
+def _init_worker(mode, output, N, low_memory, corpus_path):
+    """Build the language model of the worker process"""
+
+    global _worker_model
 
-        for i in range(len(sentences)):
-            split = []
+    _worker_model = LanguageModel(mode=mode, output=output, N=N, workers=1, low_memory=low_memory)
+    _worker_model.read_corpus(corpus_path=corpus_path)
 
-            for x in sentences[i].split():
-                sugg = symspell.lookup(x.lower(), verbosity=0, max_edit_distance=self.N,
-                                       transfer_casing=True) if x not in string.punctuation else None
-                split.append(sugg[0].term if sugg else x)
 
-            predicts.append(" ".join(split))
+def _lookup(token):
+    """Look up one token with the language model of the worker process"""
 
-        return predicts
+    return _worker_model.lookup(token.lower())
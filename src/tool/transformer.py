@@ -9,13 +9,15 @@ References:
 """
 
 import os
+import functools
 import numpy as np
 import tensorflow as tf
 
 from contextlib import redirect_stdout
 from tensorflow.keras import Input, Model
 from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.utils import Progbar, GeneratorEnqueuer
+from tensorflow.keras.layers.experimental import EinsumDense
+from tensorflow.keras.utils import Progbar
 from tensorflow.keras.callbacks import CSVLogger, TensorBoard, ModelCheckpoint
 from tensorflow.keras.callbacks import EarlyStopping, ReduceLROnPlateau
 
@@ -40,12 +42,17 @@ class Transformer():
         Jupyter Notebook: https://colab.research.google.com/drive/1YhN8ZCZhrv18Hw0a_yIkuZ5tTh4EZDuG#scrollTo=ha0dNJogUPQN
     """
 
-    def __init__(self, tokenizer, num_layers, units, d_model, num_heads, dropout=0.0, stop_tolerance=20, reduce_tolerance=15):
+    def __init__(self, tokenizer, num_layers, units, d_model, num_heads, dropout=0.0, stop_tolerance=20, reduce_tolerance=15,
+                 num_kv_heads=None):
         self.tokenizer = tokenizer
         self.num_layers = num_layers
+
+        # embedding/output sizes padded to a multiple of 8 (Tensor Cores friendly GEMMs)
+        self.vocab_size = -(-tokenizer.vocab_size // 8) * 8
         self.units = units
         self.d_model = d_model
         self.num_heads = num_heads
+        self.num_kv_heads = num_kv_heads
         self.dropout = dropout
 
         self.stop_tolerance = stop_tolerance
@@ -116,23 +123,30 @@ class Transformer():
     def compile(self, learning_rate=None, initial_step=0):
         """Build models (train, encoder and decoder)"""
 
-        enc_input = Input(shape=(None,), name="enc_input")
-        dec_input = Input(shape=(None,), name="dec_input")
+        # XLA auto-clustering, so the graph ops are fused into fewer kernels
+        tf.config.optimizer.set_jit(True)
+
+        # the generator pads the sentences to maxlen, so the masks are built for a static length
+        enc_input = Input(shape=(self.tokenizer.maxlen,), name="enc_input")
+        dec_input = Input(shape=(self.tokenizer.maxlen,), name="dec_input")
         enc_padding_mask, look_ahead_mask, dec_padding_mask = create_masks(enc_input, dec_input)
 
         self.encoder = Encoder(num_layers=self.num_layers,
                                d_model=self.d_model,
                                num_heads=self.num_heads,
+                               num_kv_heads=self.num_kv_heads,
                                dff=self.units,
-                               input_vocab_size=self.tokenizer.vocab_size,
+                               input_vocab_size=self.vocab_size,
                                maximum_position_encoding=self.tokenizer.vocab_size,
                                rate=self.dropout)
 
         self.decoder = Decoder(num_layers=self.num_layers,
                                d_model=self.d_model,
                                num_heads=self.num_heads,
+                               num_kv_heads=self.num_kv_heads,
                                dff=self.units,
-                               target_vocab_size=self.tokenizer.vocab_size,
+                               target_vocab_size=self.vocab_size,
+                               valid_vocab_size=self.tokenizer.vocab_size,
                                maximum_position_encoding=self.tokenizer.vocab_size,
                                rate=self.dropout)
 
@@ -202,75 +216,86 @@ class Transformer():
                 workers=1,
                 use_multiprocessing=False):
         """
-        Model predicting on data yielded (generator).
+        Model predicting on data yielded (tf.data.Dataset).
         A predict() abstration function of TensorFlow 2 using the encoder and decoder models
 
         :param: See tensorflow.keras.Model.predict()
         :return: A numpy array(s) of predictions.
         """
 
-        try:
-            enqueuer = GeneratorEnqueuer(x, use_multiprocessing=use_multiprocessing)
-            enqueuer.start(workers=workers, max_queue_size=max_queue_size)
-            output_generator = enqueuer.get()
+        steps_done = 0
+        if verbose == 1:
+            print("Model Predict")
+            progbar = Progbar(target=steps)
 
-            steps_done = 0
-            if verbose == 1:
-                print("Model Predict")
-                progbar = Progbar(target=steps)
+        predicts = []
+
+        # the dataset yields the (prefetched) batches as tuples of inputs
+        for (x,) in x.take(steps):
+            # the encoder output (and its keys/values in the decoder) is the same for all the steps
+            enc_padding_mask = create_padding_mask(x)
+            enc_output = self.encoder(x, enc_padding_mask)  # (batch_size, inp_seq_len, d_model)
+            cache = self.decoder.get_cache(enc_output)
+
+            # the whole batch is decoded at once, until every sentence has reached the end token
+            dec_input = tf.fill([tf.shape(x)[0], 1], self.tokenizer.SOS)
+            finished = tf.zeros([tf.shape(x)[0]], dtype=tf.bool)
 
-            predicts = []
+            for i in range(self.tokenizer.maxlen):
+                # the last token attends to all the previous ones, so only the padding is masked
+                look_ahead_mask = create_padding_mask(dec_input)
 
-            while steps_done < steps:
-                x = next(output_generator)[0]
+                predictions, cache = self.decode_step(dec_input[:, -1:], enc_output, look_ahead_mask,
+                                                      enc_padding_mask, cache, tf.constant(i))
 
-                for sentence in x:
-                    enc_input = tf.expand_dims(sentence, axis=0)
-                    dec_input = tf.expand_dims([self.tokenizer.SOS], axis=0)
+                # predictions.shape == (batch_size, 1, vocab_size)
+                predicted_id = tf.cast(tf.argmax(predictions, axis=-1), dtype=tf.int32)
 
-                    for _ in range(self.tokenizer.maxlen):
-                        enc_padding_mask, look_ahead_mask, dec_padding_mask = create_masks(enc_input, dec_input)
+                # return the results when all the predicted_ids have been equal to the end token
+                finished = tf.logical_or(finished, tf.equal(predicted_id[:, 0], self.tokenizer.EOS))
 
-                        enc_output = self.encoder(enc_input, enc_padding_mask)  # (batch_size, inp_seq_len, d_model)
-                        dec_output, _ = self.decoder(dec_input, enc_output, look_ahead_mask, dec_padding_mask)
+                if tf.reduce_all(finished):
+                    break
 
-                        # select the last word from the seq_len dimension
-                        predictions = dec_output[:, -1:, :]  # (batch_size, 1, vocab_size)
-                        predicted_id = tf.cast(tf.argmax(predictions, axis=-1), dtype=tf.int32)
+                # concatentate the predicted_id to the output which is given to the decoder as its input.
+                # the tokens after the end token (finished sentences) are discarded by `remove_tokens`
+                dec_input = tf.concat([dec_input, predicted_id], axis=-1)
 
-                        # return the result if the predicted_id is equal to the end token
-                        if tf.equal(predicted_id, self.tokenizer.EOS):
-                            break
+            for sentence in dec_input.numpy():
+                predicts.append(self.tokenizer.remove_tokens(self.tokenizer.decode(sentence)))
 
-                        # concatentate the predicted_id to the output which is given to the decoder as its input.
-                        dec_input = tf.concat([dec_input, predicted_id], axis=-1)
+            steps_done += 1
+            if verbose == 1:
+                progbar.update(steps_done)
 
-                    dec_input = tf.squeeze(dec_input, axis=0)
-                    dec_input = self.tokenizer.decode(dec_input)
+        return predicts
 
-                    predicts.append(self.tokenizer.remove_tokens(dec_input))
+    @tf.function(experimental_relax_shapes=True)
+    def decode_step(self, dec_input, enc_output, look_ahead_mask, padding_mask, cache, position):
+        """Decode the last token only, using (and updating) the keys/values of the previous steps in cache"""
 
-                steps_done += 1
-                if verbose == 1:
-                    progbar.update(steps_done)
+        # tf.function does not allow to modify the input arguments, so the updated cache is a copy
+        cache = [dict(layer_cache) for layer_cache in cache]
 
-        finally:
-            enqueuer.stop()
+        dec_output, _ = self.decoder(dec_input, enc_output, look_ahead_mask, padding_mask, cache=cache, position=position)
 
-        return predicts
+        return dec_output, cache
 
 
 class Encoder(tf.keras.layers.Layer):
-    def __init__(self, num_layers, d_model, num_heads, dff, input_vocab_size, maximum_position_encoding, rate=0.1):
+    def __init__(self, num_layers, d_model, num_heads, dff, input_vocab_size, maximum_position_encoding, rate=0.1,
+                 num_kv_heads=None):
         super(Encoder, self).__init__()
 
         self.d_model = d_model
         self.num_layers = num_layers
 
         self.embedding = tf.keras.layers.Embedding(input_vocab_size, d_model, name="enc_embedding")
+        self.embedding_scale = float(np.sqrt(d_model))
         self.pos_encoding = positional_encoding(maximum_position_encoding, self.d_model)
 
-        self.enc_layers = [EncoderLayer(d_model, num_heads, dff, rate, f"enc_layer_{i}") for i in range(num_layers)]
+        self.enc_layers = [EncoderLayer(d_model, num_heads, dff, rate, f"enc_layer_{i}", num_kv_heads)
+                           for i in range(num_layers)]
         self.dropout = tf.keras.layers.Dropout(rate, name="enc_dropout")
 
     def call(self, x, mask=None):
@@ -278,8 +303,7 @@ class Encoder(tf.keras.layers.Layer):
 
         # adding embedding and position encoding.
         x = self.embedding(x)  # (batch_size, input_seq_len, d_model)
-        x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
-        x += self.pos_encoding[:, :seq_len, :]
+        x = scale_and_add_position(x, self.pos_encoding[:, :seq_len, :], self.embedding_scale)
 
         x = self.dropout(x)
 
@@ -296,10 +320,10 @@ class Encoder(tf.keras.layers.Layer):
 
 
 class EncoderLayer(tf.keras.layers.Layer):
-    def __init__(self, d_model, num_heads, dff, rate=0.1, name="enc_layer"):
+    def __init__(self, d_model, num_heads, dff, rate=0.1, name="enc_layer", num_kv_heads=None):
         super(EncoderLayer, self).__init__()
 
-        self.mha = MultiHeadAttention(d_model, num_heads, name=f"{name}_attention")
+        self.mha = MultiHeadAttention(d_model, num_heads, name=f"{name}_attention", num_kv_heads=num_kv_heads)
         self.ffn = point_wise_feed_forward_network(d_model, dff)
 
         self.layernorm1 = tf.keras.layers.LayerNormalization(epsilon=1e-6, name=f"{name}_norm_1")
@@ -327,41 +351,64 @@ class EncoderLayer(tf.keras.layers.Layer):
 
 
 class Decoder(tf.keras.layers.Layer):
-    def __init__(self, num_layers, d_model, num_heads, dff, target_vocab_size, maximum_position_encoding, rate=0.1):
+    def __init__(self, num_layers, d_model, num_heads, dff, target_vocab_size, maximum_position_encoding, rate=0.1,
+                 valid_vocab_size=None, num_kv_heads=None):
         super(Decoder, self).__init__()
 
         self.d_model = d_model
         self.num_layers = num_layers
 
         self.embedding = tf.keras.layers.Embedding(target_vocab_size, d_model, name="dec_embedding")
+        self.embedding_scale = float(np.sqrt(d_model))
         self.pos_encoding = positional_encoding(maximum_position_encoding, d_model)
 
-        self.dec_layers = [DecoderLayer(d_model, num_heads, dff, rate, name=f"dec_layer_{i}") for i in range(num_layers)]
+        self.dec_layers = [DecoderLayer(d_model, num_heads, dff, rate, name=f"dec_layer_{i}", num_kv_heads=num_kv_heads)
+                           for i in range(num_layers)]
         self.dropout = tf.keras.layers.Dropout(rate, name="dec_dropout")
 
         self.dec_output = tf.keras.layers.Dense(target_vocab_size, name="dec_dense")
 
-    def call(self, x, enc_output, look_ahead_mask=None, padding_mask=None):
+        # the padded vocabulary indices (>= valid_vocab_size) can never be predicted
+        logits_mask = np.arange(target_vocab_size) >= (valid_vocab_size or target_vocab_size)
+        self.logits_mask = tf.constant(logits_mask * -1e9, dtype=tf.float32)
+
+    def call(self, x, enc_output, look_ahead_mask=None, padding_mask=None, cache=None, position=0):
         seq_len = tf.shape(x)[1]
         attention_weights = {}
 
         x = self.embedding(x)  # (batch_size, target_seq_len, d_model)
-        x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
-        x += self.pos_encoding[:, :seq_len, :]
+        x = scale_and_add_position(x, self.pos_encoding[:, position:position + seq_len, :], self.embedding_scale)
 
         x = self.dropout(x)
 
         for i in range(self.num_layers):
-            x, block1, block2 = self.dec_layers[i](x, enc_output, look_ahead_mask, padding_mask)
+            layer_cache = None if cache is None else cache[i]
+            x, block1, block2 = self.dec_layers[i](x, enc_output, look_ahead_mask, padding_mask, cache=layer_cache)
 
             attention_weights["decoder_layer{}_block1".format(i + 1)] = block1
             attention_weights["decoder_layer{}_block2".format(i + 1)] = block2
 
         # x.shape == (batch_size, target_seq_len, d_model)
-        output = self.dec_output(x)
+        output = self.dec_output(x) + self.logits_mask
 
         return output, attention_weights
 
+    def get_cache(self, enc_output):
+        """
+        Initial cache of the incremental decoding (one per decoder layer):
+        the keys/values of the encoder output and (still empty) the keys/values of the decoded tokens.
+        """
+
+        cache = []
+
+        for layer in self.dec_layers:
+            k, v = layer.mha1.project_kv(enc_output[:, :0, :], enc_output[:, :0, :])
+            enc_k, enc_v = layer.mha2.project_kv(enc_output, enc_output)
+
+            cache.append({"k": k, "v": v, "enc_k": enc_k, "enc_v": enc_v})
+
+        return cache
+
     def get_config(self):
         """Return the config of the layer"""
 
@@ -370,11 +417,11 @@ class Decoder(tf.keras.layers.Layer):
 
 
 class DecoderLayer(tf.keras.layers.Layer):
-    def __init__(self, d_model, num_heads, dff, rate=0.1, name="dec_layer"):
+    def __init__(self, d_model, num_heads, dff, rate=0.1, name="dec_layer", num_kv_heads=None):
         super(DecoderLayer, self).__init__()
 
-        self.mha1 = MultiHeadAttention(d_model, num_heads, name=f"{name}_attention_1")
-        self.mha2 = MultiHeadAttention(d_model, num_heads, name=f"{name}_attention_2")
+        self.mha1 = MultiHeadAttention(d_model, num_heads, name=f"{name}_attention_1", num_kv_heads=num_kv_heads)
+        self.mha2 = MultiHeadAttention(d_model, num_heads, name=f"{name}_attention_2", num_kv_heads=num_kv_heads)
 
         self.ffn = point_wise_feed_forward_network(d_model, dff)
 
@@ -386,14 +433,19 @@ class DecoderLayer(tf.keras.layers.Layer):
         self.dropout2 = tf.keras.layers.Dropout(rate, name=f"{name}_dropout_2")
         self.dropout3 = tf.keras.layers.Dropout(rate, name=f"{name}_dropout_3")
 
-    def call(self, x, enc_output, look_ahead_mask=None, padding_mask=None):
+    def call(self, x, enc_output, look_ahead_mask=None, padding_mask=None, cache=None):
         # enc_output.shape == (batch_size, input_seq_len, d_model)
 
-        attn1, attn_weights_block1 = self.mha1(x, x, x, look_ahead_mask)  # (batch_size, target_seq_len, d_model)
+        attn1, attn_weights_block1 = self.mha1(x, x, x, look_ahead_mask, cache=cache)  # (batch_size, target_seq_len, d_model)
         attn1 = self.dropout1(attn1)
         out1 = self.layernorm1(attn1 + x)
 
-        attn2, attn_weights_block2 = self.mha2(enc_output, enc_output, out1, padding_mask)  # (batch_size, target_seq_len, d_model)
+        if cache is None:
+            attn2, attn_weights_block2 = self.mha2(enc_output, enc_output, out1, padding_mask)  # (batch_size, target_seq_len, d_model)
+        else:
+            # the keys/values of the encoder output are computed once for all the decoding steps
+            attn2, attn_weights_block2 = self.mha2.attend(out1, cache["enc_k"], cache["enc_v"], padding_mask)
+
         attn2 = self.dropout2(attn2)
         out2 = self.layernorm2(attn2 + out1)  # (batch_size, target_seq_len, d_model)
 
@@ -411,49 +463,60 @@ class DecoderLayer(tf.keras.layers.Layer):
 
 
 class MultiHeadAttention(tf.keras.layers.Layer):
-    def __init__(self, d_model, num_heads, name="multi_head_attention"):
+    def __init__(self, d_model, num_heads, name="multi_head_attention", num_kv_heads=None):
         super(MultiHeadAttention, self).__init__(name=name)
         self.num_heads = num_heads
         self.d_model = d_model
 
+        # grouped-query attention: each key/value head is shared by (num_heads // num_kv_heads) query heads
+        self.num_kv_heads = num_kv_heads or num_heads
+
         assert d_model % self.num_heads == 0
+        assert self.num_heads % self.num_kv_heads == 0
 
         self.depth = d_model // self.num_heads
 
-        self.wq = tf.keras.layers.Dense(d_model)
-        self.wk = tf.keras.layers.Dense(d_model)
-        self.wv = tf.keras.layers.Dense(d_model)
+        # the projections go straight to/from (num_heads, depth), without reshapes
+        self.wq = EinsumDense("abc,cde->abde", output_shape=(None, num_heads, self.depth), bias_axes="de")
+        self.wk = EinsumDense("abc,cde->abde", output_shape=(None, self.num_kv_heads, self.depth), bias_axes="de")
+        self.wv = EinsumDense("abc,cde->abde", output_shape=(None, self.num_kv_heads, self.depth), bias_axes="de")
 
-        self.dense = tf.keras.layers.Dense(d_model)
+        self.dense = EinsumDense("abcd,cde->abe", output_shape=(None, d_model), bias_axes="e")
 
-    def split_heads(self, x, batch_size):
-        """
-        Split the last dimension into (num_heads, depth).
-        Transpose the result such that the shape is (batch_size, num_heads, seq_len, depth)
-        """
-        x = tf.reshape(x, (batch_size, -1, self.num_heads, self.depth))
-        return tf.transpose(x, perm=[0, 2, 1, 3])
+    def call(self, v, k, q, mask=None, cache=None):
+        k, v = self.project_kv(v, k)
 
-    def call(self, v, k, q, mask=None):
-        batch_size = tf.shape(q)[0]
+        # keys/values of the previous decoding steps (the cache is updated with the new ones)
+        if cache is not None:
+            k = tf.concat([cache["k"], k], axis=1)
+            v = tf.concat([cache["v"], v], axis=1)
+            cache["k"], cache["v"] = k, v
 
-        q = self.wq(q)  # (batch_size, seq_len, d_model)
-        k = self.wk(k)  # (batch_size, seq_len, d_model)
-        v = self.wv(v)  # (batch_size, seq_len, d_model)
+        return self.attend(q, k, v, mask)
 
-        q = self.split_heads(q, batch_size)  # (batch_size, num_heads, seq_len_q, depth)
-        k = self.split_heads(k, batch_size)  # (batch_size, num_heads, seq_len_k, depth)
-        v = self.split_heads(v, batch_size)  # (batch_size, num_heads, seq_len_v, depth)
+    def project_kv(self, v, k):
+        """Project the keys/values in heads, shape == (batch_size, seq_len, num_kv_heads, depth)"""
 
-        # scaled_attention.shape == (batch_size, num_heads, seq_len_q, depth)
-        # attention_weights.shape == (batch_size, num_heads, seq_len_q, seq_len_k)
-        scaled_attention, attention_weights = scaled_dot_product_attention(q, k, v, mask)
+        k = self.wk(k)  # (batch_size, seq_len_k, num_kv_heads, depth)
+        v = self.wv(v)  # (batch_size, seq_len_v, num_kv_heads, depth)
+
+        return k, v
+
+    def attend(self, q, k, v, mask=None):
+        """Attention of the query over the keys/values already projected (see `project_kv`)"""
 
-        scaled_attention = tf.transpose(scaled_attention, perm=[0, 2, 1, 3])  # (batch_size, seq_len_q, num_heads, depth)
+        q = self.wq(q)  # (batch_size, seq_len_q, num_heads, depth)
 
-        concat_attention = tf.reshape(scaled_attention, (batch_size, -1, self.d_model))  # (batch_size, seq_len_q, d_model)
+        # the (cached) key/value heads are shared by the groups of query heads
+        if self.num_kv_heads != self.num_heads:
+            k = tf.repeat(k, self.num_heads // self.num_kv_heads, axis=2)  # (batch_size, seq_len_k, num_heads, depth)
+            v = tf.repeat(v, self.num_heads // self.num_kv_heads, axis=2)  # (batch_size, seq_len_v, num_heads, depth)
 
-        output = self.dense(concat_attention)  # (batch_size, seq_len_q, d_model)
+        # scaled_attention.shape == (batch_size, seq_len_q, num_heads, depth)
+        # attention_weights.shape == (batch_size, num_heads, seq_len_q, seq_len_k)
+        scaled_attention, attention_weights = scaled_dot_product_attention(q, k, v, mask)
+
+        output = self.dense(scaled_attention)  # (batch_size, seq_len_q, d_model)
 
         return output, attention_weights
 
@@ -482,7 +545,8 @@ def positional_encoding(position, d_model):
 
     pos_encoding = angle_rads[np.newaxis, ...]
 
-    return tf.cast(pos_encoding, dtype=tf.float32)
+    # a fixed table, so build the constant directly from the numpy array (no cast op)
+    return tf.constant(pos_encoding, dtype=tf.float32)
 
 
 def get_angles(pos, i, d_model):
@@ -490,39 +554,51 @@ def get_angles(pos, i, d_model):
     return pos * angle_rates
 
 
+@tf.function(experimental_compile=True)
+def scale_and_add_position(x, pos_encoding, scale):
+    """Scale the embeddings by sqrt(d_model) and add the position encoding (fused by XLA in one kernel)"""
+
+    x *= scale
+    x += pos_encoding
+
+    return x
+
+
+@tf.function(experimental_compile=True)
 def scaled_dot_product_attention(q, k, v, mask):
-    """Calculate the attention weights.
-    q, k, v must have matching leading dimensions.
-    k, v must have matching penultimate dimension, i.e.: seq_len_k = seq_len_v.
+    """Calculate the attention weights (compiled with XLA into a single fused computation).
+    q, k, v are in the (batch_size, seq_len, num_heads, depth) layout of the projections,
+    so the einsums contract them without transposing the heads.
+    k, v must have matching sequence dimension, i.e.: seq_len_k = seq_len_v.
     The mask has different shapes depending on its type(padding or look ahead)
     but it must be broadcastable for addition.
 
     Args:
-      q: query shape == (..., seq_len_q, depth)
-      k: key shape == (..., seq_len_k, depth)
-      v: value shape == (..., seq_len_v, depth_v)
+      q: query shape == (batch_size, seq_len_q, num_heads, depth)
+      k: key shape == (batch_size, seq_len_k, num_heads, depth)
+      v: value shape == (batch_size, seq_len_v, num_heads, depth_v)
       mask: Float tensor with shape broadcastable
-            to (..., seq_len_q, seq_len_k). Defaults to None.
+            to (batch_size, num_heads, seq_len_q, seq_len_k). Defaults to None.
 
     Returns:
       output, attention_weights
     """
 
-    matmul_qk = tf.matmul(q, k, transpose_b=True)  # (..., seq_len_q, seq_len_k)
-
-    # scale matmul_qk
+    # scale q instead of matmul_qk (seq_len_q * depth values instead of seq_len_q * seq_len_k)
     dk = tf.cast(tf.shape(k)[-1], tf.float32)
-    scaled_attention_logits = matmul_qk / tf.math.sqrt(dk)
+    q *= tf.math.rsqrt(dk)
 
-    # add the mask to the scaled tensor.
+    scaled_attention_logits = tf.einsum("bqhd,bkhd->bhqk", q, k)  # (batch_size, num_heads, seq_len_q, seq_len_k)
+
+    # replace the masked logits in a single select.
     if mask is not None:
-        scaled_attention_logits += (mask * -1e9)
+        scaled_attention_logits = tf.where(tf.cast(mask, tf.bool), -1e9, scaled_attention_logits)
 
     # softmax is normalized on the last axis (seq_len_k) so that the scores
     # add up to 1.
-    attention_weights = tf.nn.softmax(scaled_attention_logits, axis=-1)  # (..., seq_len_q, seq_len_k)
+    attention_weights = tf.nn.softmax(scaled_attention_logits, axis=-1)  # (batch_size, num_heads, seq_len_q, seq_len_k)
 
-    output = tf.matmul(attention_weights, v)  # (..., seq_len_q, depth_v)
+    output = tf.einsum("bhqk,bkhd->bqhd", attention_weights, v)  # (batch_size, seq_len_q, num_heads, depth_v)
 
     return output, attention_weights
 
@@ -536,11 +612,16 @@ class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
         self.initial_step = initial_step
         self.warmup_steps = warmup_steps
 
+        # the constant factors of the schedule are computed only once
+        self.rsqrt_d_model = tf.math.rsqrt(self.d_model)
+        self.warmup_factor = self.warmup_steps ** -1.5
+
+    @tf.function(input_signature=[tf.TensorSpec([], tf.float32)])
     def __call__(self, step):
         arg1 = tf.math.rsqrt(step + self.initial_step)
-        arg2 = step * (self.warmup_steps ** -1.5)
+        arg2 = step * self.warmup_factor
 
-        return tf.math.rsqrt(self.d_model) * tf.math.minimum(arg1, arg2)
+        return self.rsqrt_d_model * tf.math.minimum(arg1, arg2)
 
 
 def create_masks(inp=None, tar=None):
@@ -554,7 +635,7 @@ def create_masks(inp=None, tar=None):
     # Used in the 1st attention block in the decoder.
     # It is used to pad and mask future tokens in the input received by
     # the decoder.
-    look_ahead_mask = create_look_ahead_mask(tf.shape(tar)[1])
+    look_ahead_mask = create_look_ahead_mask(tar.shape[1] or tf.shape(tar)[1])
     dec_target_padding_mask = create_padding_mask(tar)
     combined_mask = tf.maximum(dec_target_padding_mask, look_ahead_mask)
 
@@ -570,14 +651,27 @@ def create_padding_mask(seq):
 
 
 def create_look_ahead_mask(size):
+    # static length, so the same constant mask is reused
+    if isinstance(size, int):
+        return look_ahead_mask_constant(size)
+
     mask = 1 - tf.linalg.band_part(tf.ones((size, size)), -1, 0)
     return mask  # (seq_len, seq_len)
 
 
+@functools.lru_cache(maxsize=None)
+def look_ahead_mask_constant(size):
+    mask = 1 - np.tri(size, dtype=np.float32)
+    return tf.constant(mask)  # (seq_len, seq_len)
+
+
+# built once, instead of at each loss computation
+LOSS_OBJECT = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction="none")
+
+
 def loss_func(y_true, y_pred):
-    loss_object = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction="none")
     mask = tf.math.logical_not(tf.math.equal(y_true, 0))
-    loss_ = loss_object(y_true, y_pred)
+    loss_ = LOSS_OBJECT(y_true, y_pred)
 
     mask = tf.cast(mask, dtype=loss_.dtype)
     loss_ *= mask